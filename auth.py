@@ -1,32 +1,127 @@
 from datetime import datetime, timedelta, timezone
-from typing import Optional
+from typing import Optional, Tuple
+import base64
+import binascii
+import hashlib
+import hmac
 import os
 import secrets
-from jose import JWTError, jwt
-from passlib.context import CryptContext
-from fastapi import Depends, HTTPException, status
-from fastapi.security import HTTPBearer, HTTPAuthorizationCredentials
-from sqlalchemy.orm import Session
+import threading
+import time
+import bcrypt
+import orjson
+from argon2 import PasswordHasher
+from argon2.exceptions import InvalidHash, VerificationError
+from cachetools import TTLCache
+from fastapi import Depends, HTTPException, Request, status
+from fastapi.concurrency import run_in_threadpool
+from fastapi.security import HTTPBearer
+from sqlalchemy import select, update
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.orm import load_only
 from database import get_db
 from models import User, RefreshToken
+from schemas import TokenData
 
-# Password hashing
-pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto")
+# Password hashing: argon2id at OWASP's baseline cost (19 MiB, 2 passes). bcrypt
+# hashes from before the switch still verify and are upgraded on the next login.
+_password_hasher = PasswordHasher(time_cost=2, memory_cost=19456, parallelism=1)
 
 # JWT settings
 SECRET_KEY = os.getenv("SECRET_KEY", "your-secret-key-change-in-production")
-ALGORITHM = os.getenv("ALGORITHM", "HS256")
+ALGORITHM = "HS256"
 ACCESS_TOKEN_EXPIRE_MINUTES = 30
 REFRESH_TOKEN_EXPIRE_DAYS = 7
 
+class BearerToken(HTTPBearer):
+    """HTTPBearer that returns the raw token string
+
+    Keeps the same OpenAPI security scheme and error responses, but skips
+    building an HTTPAuthorizationCredentials model on every request.
+    """
+
+    async def __call__(self, request: Request) -> Optional[str]:
+        authorization = request.headers.get("Authorization")
+        scheme, _, token = authorization.partition(" ") if authorization else ("", "", "")
+        if not (scheme and token):
+            if self.auto_error:
+                raise HTTPException(status_code=status.HTTP_403_FORBIDDEN, detail="Not authenticated")
+            return None
+        if scheme.lower() != "bearer":
+            if self.auto_error:
+                raise HTTPException(status_code=status.HTTP_403_FORBIDDEN, detail="Invalid authentication credentials")
+            return None
+        return token
+
 # Security scheme
-security = HTTPBearer()
+security = BearerToken(scheme_name="HTTPBearer")
+
+# Verified access tokens: blake2b(token) -> (TokenData, exp)
+_token_cache = TTLCache(maxsize=10_000, ttl=60)
+_token_cache_lock = threading.Lock()
+
+# Detached, fully loaded users: user_id -> User
+_user_cache = TTLCache(maxsize=10_000, ttl=30)
+_user_cache_lock = threading.Lock()
+
+def _b64url_encode(data: bytes) -> bytes:
+    return base64.urlsafe_b64encode(data).rstrip(b"=")
+
+def _b64url_decode(data: bytes) -> bytes:
+    return base64.urlsafe_b64decode(data + b"=" * (-len(data) % 4))
+
+# Keyed once at import; copying it skips re-deriving the HMAC pads per token
+_HMAC_TEMPLATE = hmac.new(SECRET_KEY.encode(), digestmod=hashlib.sha256)
+# Every token shares the same header, so encode it once
+_JWT_HEADER = _b64url_encode(orjson.dumps({"alg": ALGORITHM, "typ": "JWT"}))
+
+def _sign(signing_input: bytes) -> bytes:
+    mac = _HMAC_TEMPLATE.copy()
+    mac.update(signing_input)
+    return mac.digest()
+
+def _encode_jwt(payload: dict) -> str:
+    signing_input = _JWT_HEADER + b"." + _b64url_encode(orjson.dumps(payload))
+    return (signing_input + b"." + _b64url_encode(_sign(signing_input))).decode()
+
+def _decode_jwt(token: str) -> Optional[dict]:
+    """Return the claims of a correctly signed, unexpired HS256 token"""
+    try:
+        signing_input, signature = token.encode().rsplit(b".", 1)
+        header, payload = signing_input.split(b".")
+        if not hmac.compare_digest(_b64url_decode(signature), _sign(signing_input)):
+            return None
+        header = orjson.loads(_b64url_decode(header))
+        claims = orjson.loads(_b64url_decode(payload))
+    except (ValueError, binascii.Error):
+        return None
+
+    if not isinstance(header, dict) or header.get("alg") != ALGORITHM:
+        return None
+    if not isinstance(claims, dict):
+        return None
+
+    exp = claims.get("exp")
+    if not isinstance(exp, (int, float)) or exp <= time.time():
+        return None
+    return claims
+
+def _is_bcrypt_hash(hashed_password: str) -> bool:
+    return hashed_password.startswith("$2")
 
 def verify_password(plain_password: str, hashed_password: str) -> bool:
-    return pwd_context.verify(plain_password, hashed_password)
+    if _is_bcrypt_hash(hashed_password):
+        return bcrypt.checkpw(plain_password.encode(), hashed_password.encode())
+    try:
+        return _password_hasher.verify(hashed_password, plain_password)
+    except (VerificationError, InvalidHash):
+        return False
+
+def password_needs_rehash(hashed_password: str) -> bool:
+    return _is_bcrypt_hash(hashed_password) or _password_hasher.check_needs_rehash(hashed_password)
 
 def get_password_hash(password: str) -> str:
-    return pwd_context.hash(password)
+    return _password_hasher.hash(password)
 
 def create_access_token(data: dict, expires_delta: Optional[timedelta] = None):
     to_encode = data.copy()
@@ -34,81 +129,145 @@ def create_access_token(data: dict, expires_delta: Optional[timedelta] = None):
         expire = datetime.now(timezone.utc) + expires_delta
     else:
         expire = datetime.now(timezone.utc) + timedelta(minutes=ACCESS_TOKEN_EXPIRE_MINUTES)
-    to_encode.update({"exp": expire, "type": "access"})
-    encoded_jwt = jwt.encode(to_encode, SECRET_KEY, algorithm=ALGORITHM)
+    to_encode.update({"exp": int(expire.timestamp()), "type": "access"})
+    encoded_jwt = _encode_jwt(to_encode)
     return encoded_jwt
 
-def create_refresh_token(db: Session, user_id: int) -> str:
+def _hash_refresh_token(token: str) -> bytes:
+    return hashlib.sha256(token.encode()).digest()
+
+def _add_refresh_token(db: AsyncSession, user_id: int) -> str:
     # Generate secure random token
     token = secrets.token_urlsafe(32)
 
     # Set expiration
     expires_at = datetime.now(timezone.utc) + timedelta(days=REFRESH_TOKEN_EXPIRE_DAYS)
 
-    # Store in database
+    # Store only the hash, the raw token is handed to the client
     db_token = RefreshToken(
-        token=token,
+        token_hash=_hash_refresh_token(token),
         user_id=user_id,
         expires_at=expires_at
     )
     db.add(db_token)
-    db.commit()
 
     return token
 
-def verify_token(token: str) -> Optional[str]:
-    try:
-        payload = jwt.decode(token, SECRET_KEY, algorithms=[ALGORITHM])
-        email: str = payload.get("sub")
-        token_type: str = payload.get("type")
-        if email is None or token_type != "access":
-            return None
-        return email
-    except JWTError:
+async def create_refresh_token(db: AsyncSession, user_id: int) -> str:
+    token = _add_refresh_token(db, user_id)
+    await db.commit()
+    return token
+
+async def rotate_refresh_token(db: AsyncSession, token: str) -> Optional[Tuple[int, str, str]]:
+    """Swap a valid refresh token for a new one in a single transaction
+
+    Returns the owner's id and email plus the new raw token, or None if the
+    token is unknown, revoked or expired.
+    """
+    # Revoke and look up the owner in one statement; the row lock also makes
+    # concurrent reuse of the same token lose the race
+    result = await db.execute(
+        update(RefreshToken).where(
+            RefreshToken.token_hash == _hash_refresh_token(token),
+            RefreshToken.is_active == True,
+            RefreshToken.expires_at > datetime.now(timezone.utc),
+            RefreshToken.user_id == User.id
+        ).values(is_active=False).returning(User.id, User.email)
+        .execution_options(synchronize_session=False)
+    )
+    owner = result.first()
+    if owner is None:
+        await db.rollback()
         return None
 
-def verify_refresh_token(db: Session, token: str) -> Optional[User]:
-    # Get token from database
-    db_token = db.query(RefreshToken).filter(
-        RefreshToken.token == token,
-        RefreshToken.is_active == True,
-        RefreshToken.expires_at > datetime.now(timezone.utc)
-    ).first()
+    user_id, email = owner
+    new_token = _add_refresh_token(db, user_id)
+    await db.commit()
+    return user_id, email, new_token
 
-    if not db_token:
+def _token_cache_key(token: str) -> bytes:
+    return hashlib.blake2b(token.encode(), digest_size=16).digest()
+
+def _invalidate_cached_tokens(user_id: int):
+    with _token_cache_lock:
+        for key in list(_token_cache.keys()):
+            cached = _token_cache.get(key)
+            if cached is not None and cached[0].user_id == user_id:
+                _token_cache.pop(key, None)
+    with _user_cache_lock:
+        _user_cache.pop(user_id, None)
+
+def verify_token(token: str) -> Optional[TokenData]:
+    cache_key = _token_cache_key(token)
+    with _token_cache_lock:
+        cached = _token_cache.get(cache_key)
+    if cached is not None:
+        token_data, exp = cached
+        if exp > time.time():
+            return token_data
+
+    payload = _decode_jwt(token)
+    if payload is None:
+        return None
+
+    email: str = payload.get("sub")
+    token_type: str = payload.get("type")
+    if email is None or token_type != "access":
         return None
+    token_data = TokenData(email=email, user_id=payload.get("uid"))
 
-    return db_token.user
+    # Only successfully validated tokens are cached
+    with _token_cache_lock:
+        _token_cache[cache_key] = (token_data, payload["exp"])
+    return token_data
 
-def revoke_refresh_token(db: Session, token: str) -> bool:
-    db_token = db.query(RefreshToken).filter(RefreshToken.token == token).first()
+async def revoke_refresh_token(db: AsyncSession, token: str) -> bool:
+    result = await db.execute(
+        select(RefreshToken).where(RefreshToken.token_hash == _hash_refresh_token(token))
+    )
+    db_token = result.scalars().first()
     if db_token:
         db_token.is_active = False
-        db.commit()
+        await db.commit()
         return True
     return False
 
-def revoke_all_user_tokens(db: Session, user_id: int):
-    db.query(RefreshToken).filter(
-        RefreshToken.user_id == user_id,
-        RefreshToken.is_active == True
-    ).update({"is_active": False})
-    db.commit()
+async def revoke_all_user_tokens(db: AsyncSession, user_id: int):
+    await db.execute(
+        update(RefreshToken).where(
+            RefreshToken.user_id == user_id,
+            RefreshToken.is_active == True
+        ).values(is_active=False).execution_options(synchronize_session=False)
+    )
+    await db.commit()
+    _invalidate_cached_tokens(user_id)
 
-def get_user_by_email(db: Session, email: str) -> Optional[User]:
-    return db.query(User).filter(User.email == email).first()
+async def get_user_by_email(db: AsyncSession, email: str) -> Optional[User]:
+    result = await db.execute(select(User).where(User.email == email))
+    return result.scalars().first()
 
-def authenticate_user(db: Session, email: str, password: str) -> Optional[User]:
-    user = get_user_by_email(db, email)
+async def authenticate_user(db: AsyncSession, email: str, password: str) -> Optional[User]:
+    # Login only needs the credentials, so skip hydrating the rest of the row
+    result = await db.execute(
+        select(User).options(
+            load_only(User.id, User.email, User.hashed_password, User.is_active)
+        ).where(User.email == email)
+    )
+    user = result.scalars().first()
     if not user:
         return None
-    if not verify_password(password, user.hashed_password):
+    # Password hashing is deliberately slow, keep it off the event loop
+    if not await run_in_threadpool(verify_password, password, user.hashed_password):
         return None
+    if password_needs_rehash(user.hashed_password):
+        # Upgrade legacy or outdated hashes while the plain password is at hand
+        user.hashed_password = await run_in_threadpool(get_password_hash, password)
+        await db.commit()
     return user
 
-def get_current_user(
-    credentials: HTTPAuthorizationCredentials = Depends(security),
-    db: Session = Depends(get_db)
+async def get_current_user(
+    token: str = Depends(security),
+    db: AsyncSession = Depends(get_db)
 ) -> User:
     credentials_exception = HTTPException(
         status_code=status.HTTP_401_UNAUTHORIZED,
@@ -116,13 +275,26 @@ def get_current_user(
         headers={"WWW-Authenticate": "Bearer"},
     )
 
-    token = credentials.credentials
-    email = verify_token(token)
-    if email is None:
+    token_data = verify_token(token)
+    if token_data is None:
         raise credentials_exception
 
-    user = get_user_by_email(db, email)
+    if token_data.user_id is not None:
+        with _user_cache_lock:
+            user = _user_cache.get(token_data.user_id)
+        if user is not None:
+            return user
+
+        # Primary key lookup, answered from the session's identity map when possible
+        user = await db.get(User, token_data.user_id)
+    else:
+        # Tokens issued before the uid claim was added
+        user = await get_user_by_email(db, token_data.email)
     if user is None:
         raise credentials_exception
 
+    # Detach the loaded row so later commits in this session can't expire the cached copy
+    db.expunge(user)
+    with _user_cache_lock:
+        _user_cache[user.id] = user
     return user
\ No newline at end of file
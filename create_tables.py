@@ -1,10 +1,13 @@
+import asyncio
 from database import engine, Base
 from models import User, Document, DocumentChunk
 
-def create_tables():
+async def create_tables():
     print("Creating database tables...")
-    Base.metadata.create_all(bind=engine)
+    async with engine.begin() as conn:
+        await conn.run_sync(Base.metadata.create_all)
+    await engine.dispose()
     print("Tables created successfully!")
 
 if __name__ == "__main__":
-    create_tables()
\ No newline at end of file
+    asyncio.run(create_tables())
\ No newline at end of file
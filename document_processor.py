@@ -1,10 +1,13 @@
 import os
+import re
+import fitz
 import magic
-from typing import  List
-from PyPDF2 import PdfReader
-from bs4 import BeautifulSoup
+import tiktoken
+from functools import lru_cache
+from typing import  BinaryIO, List
+from selectolax.parser import HTMLParser
 from fastapi import HTTPException
-import tempfile
+from fastapi.concurrency import run_in_threadpool
 
 # Allowed file types
 ALLOWED_EXTENSIONS = {'.pdf', '.txt', '.md', '.html', '.htm'}
@@ -19,6 +22,21 @@ ALLOWED_MIME_TYPES = {
 
 MAX_FILE_SIZE = 10 * 1024 * 1024  # 10MB
 
+# Magic numbers live at the start of the file, so only sniff the header
+MIME_SNIFF_SIZE = 2048
+_mime_detector = magic.Magic(mime=True)
+
+# MIME types grouped by the extractor that handles them
+TEXT_MIME_TYPES = frozenset({'text/plain', 'text/markdown'})
+HTML_MIME_TYPES = frozenset({'text/html', 'application/xhtml+xml'})
+
+# Tokenizer used by the embedding model (cl100k_base for text-embedding-3-small)
+EMBEDDING_ENCODING = "cl100k_base"
+
+_WS_RE = re.compile(r'\s+')
+# Elements whose text is never document content (selectolax wants a list)
+_STRIPPED_HTML_TAGS = ["script", "style"]
+
 def validate_file_type(filename: str, content: bytes) -> str:
     """Validate file type and return MIME type"""
     # Check file extension
@@ -31,7 +49,7 @@ def validate_file_type(filename: str, content: bytes) -> str:
 
     # Check MIME type using python-magic
     try:
-        mime_type = magic.from_buffer(content, mime=True)
+        mime_type = _mime_detector.from_buffer(content[:MIME_SNIFF_SIZE])
         if mime_type not in ALLOWED_MIME_TYPES:
             raise HTTPException(
                 status_code=400,
@@ -49,9 +67,11 @@ def validate_file_type(filename: str, content: bytes) -> str:
         else:
             raise HTTPException(status_code=400, detail="Could not determine file type")
 
-def validate_file_size(content: bytes) -> int:
-    """Validate file size"""
-    file_size = len(content)
+def validate_file_size(file: BinaryIO) -> int:
+    """Validate file size without reading the file into memory"""
+    file.seek(0, os.SEEK_END)
+    file_size = file.tell()
+    file.seek(0)
     if file_size > MAX_FILE_SIZE:
         raise HTTPException(
             status_code=400,
@@ -59,15 +79,19 @@ def validate_file_size(content: bytes) -> int:
         )
     return file_size
 
-async def extract_text_from_file(content: bytes, mime_type: str, filename: str) -> str:
+async def extract_text_from_file(file: BinaryIO, mime_type: str, filename: str) -> str:
     """Extract text content from uploaded file"""
     try:
+        # The upload may have spilled to disk, so read it off the event loop too
+        content = await run_in_threadpool(file.read)
+
         if mime_type == 'application/pdf':
-            return await extract_text_from_pdf(content)
-        elif mime_type in ['text/plain', 'text/markdown']:
+            # Parsing is CPU-bound, so keep it off the event loop
+            return await run_in_threadpool(extract_text_from_pdf, content)
+        elif mime_type in TEXT_MIME_TYPES:
             return content.decode('utf-8')
-        elif mime_type in ['text/html', 'application/xhtml+xml']:
-            return extract_text_from_html(content)
+        elif mime_type in HTML_MIME_TYPES:
+            return await run_in_threadpool(extract_text_from_html, content)
         else:
             raise HTTPException(status_code=400, detail="Unsupported file type for text extraction")
     except UnicodeDecodeError:
@@ -75,35 +99,24 @@ async def extract_text_from_file(content: bytes, mime_type: str, filename: str)
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Error processing file: {str(e)}")
 
-async def extract_text_from_pdf(content: bytes) -> str:
+def extract_text_from_pdf(content: bytes) -> str:
     """Extract text from PDF file"""
     try:
-        # Create temporary file for PyPDF2
-        with tempfile.NamedTemporaryFile(delete=False, suffix='.pdf') as tmp_file:
-            tmp_file.write(content)
-            tmp_file_path = tmp_file.name
-
-        try:
-            # Extract text using PyPDF2
-            with open(tmp_file_path, 'rb') as file:
-                pdf_reader = PdfReader(file)
-                text_content = []
-
-                for page_num, page in enumerate(pdf_reader.pages):
-                    page_text = page.extract_text()
-                    if page_text.strip():
-                        text_content.append(f"--- Page {page_num + 1} ---\n{page_text}")
-
-                if not text_content:
-                    raise HTTPException(
-                        status_code=400,
-                        detail="No text content found in PDF"
-                    )
-
-                return "\n\n".join(text_content)
-        finally:
-            # Clean up temporary file
-            os.unlink(tmp_file_path)
+        # Parse the PDF straight from memory with MuPDF
+        text_content = []
+        with fitz.open(stream=content, filetype="pdf") as pdf_document:
+            for page_num, page in enumerate(pdf_document):
+                page_text = page.get_text()
+                if page_text.strip():
+                    text_content.append(f"--- Page {page_num + 1} ---\n{page_text}")
+
+        if not text_content:
+            raise HTTPException(
+                status_code=400,
+                detail="No text content found in PDF"
+            )
+
+        return "\n\n".join(text_content)
 
     except Exception as e:
         raise HTTPException(
@@ -115,19 +128,14 @@ def extract_text_from_html(content: bytes) -> str:
     """Extract text from HTML file"""
     try:
         html_content = content.decode('utf-8')
-        soup = BeautifulSoup(html_content, 'html.parser')
+        tree = HTMLParser(html_content)
 
         # Remove script and style elements
-        for script in soup(["script", "style"]):
-            script.decompose()
+        tree.strip_tags(_STRIPPED_HTML_TAGS)
 
-        # Get text and clean it up
-        text = soup.get_text()
-
-        # Clean up whitespace
-        lines = (line.strip() for line in text.splitlines())
-        chunks = (phrase.strip() for line in lines for phrase in line.split("  "))
-        text = ' '.join(chunk for chunk in chunks if chunk)
+        # Get text and collapse runs of whitespace
+        text = tree.root.text() if tree.root else ""
+        text = _WS_RE.sub(' ', text).strip()
 
         if not text.strip():
             raise HTTPException(
@@ -147,32 +155,28 @@ def extract_text_from_html(content: bytes) -> str:
             detail=f"Error extracting text from HTML: {str(e)}"
         )
 
-def chunk_text(text: str, chunk_size: int = 1000, overlap: int = 200) -> List[str]:
-    """Split text into overlapping chunks for vector storage"""
-    if len(text) <= chunk_size:
+@lru_cache(maxsize=None)
+def get_tokenizer() -> tiktoken.Encoding:
+    """Load the embedding tokenizer once, on first use"""
+    return tiktoken.get_encoding(EMBEDDING_ENCODING)
+
+def chunk_text(text: str, chunk_size: int = 256, overlap: int = 32) -> List[str]:
+    """Split text into overlapping chunks of at most chunk_size tokens"""
+    encoding = get_tokenizer()
+    # Treat special-token text like <|endoftext|> in a document as plain text
+    tokens = encoding.encode_ordinary(text)
+    if len(tokens) <= chunk_size:
         return [text]
 
     chunks = []
-    start = 0
-
-    while start < len(text):
-        end = start + chunk_size
-
-        # Try to break at sentence boundaries
-        if end < len(text):
-            # Look for sentence endings near the chunk boundary
-            for i in range(end - 100, min(end + 100, len(text))):
-                if text[i] in '.!?\n':
-                    end = i + 1
-                    break
-
-        chunk = text[start:end].strip()
+    step = chunk_size - overlap
+    for start in range(0, len(tokens), step):
+        window = tokens[start:start + chunk_size]
+        # A window edge can split a multi-byte character, drop the partial bytes
+        chunk = encoding.decode_bytes(window).decode('utf-8', errors='ignore').strip()
         if chunk:
             chunks.append(chunk)
-
-        # Move start position with overlap
-        start = end - overlap
-        if start >= len(text):
+        if start + chunk_size >= len(tokens):
             break
 
     return chunks
\ No newline at end of file
@@ -1,15 +1,20 @@
-from fastapi import FastAPI, Depends, HTTPException, status, UploadFile, File
+from fastapi import FastAPI, Depends, HTTPException, status, UploadFile, File, Query
+from fastapi.concurrency import run_in_threadpool
+from fastapi.responses import ORJSONResponse, StreamingResponse
 from fastapi.security import HTTPBearer
-from sqlalchemy.orm import Session
+from sqlalchemy import func, select, update
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.orm import load_only
 from datetime import timedelta
-from typing import List
+from typing import List, Tuple
 from dotenv import load_dotenv
+import asyncio
 import os
 
 from database import get_db
 from models import User, Document, DocumentChunk
 from schemas import UserCreate, UserLogin, UserResponse, Token, TokenRefresh, DocumentResponse, DocumentListResponse, SearchRequest, SearchResponse, QuestionRequest, QuestionResponse
-from document_processor import validate_file_type, validate_file_size, extract_text_from_file, chunk_text
+from document_processor import validate_file_type, validate_file_size, extract_text_from_file, chunk_text, MIME_SNIFF_SIZE
 from vector_store import vector_store
 from rag_service import rag_service
 from auth import (
@@ -17,7 +22,7 @@ from auth import (
     authenticate_user,
     create_access_token,
     create_refresh_token,
-    verify_refresh_token,
+    rotate_refresh_token,
     revoke_refresh_token,
     revoke_all_user_tokens,
     get_current_user,
@@ -32,6 +37,17 @@ app = FastAPI(
     version="1.0.0"
 )
 
+# Columns served by DocumentResponse; leaves out the potentially huge `content` column
+DOCUMENT_SUMMARY_COLUMNS = (
+    Document.id,
+    Document.title,
+    Document.filename,
+    Document.file_size,
+    Document.mime_type,
+    Document.processed,
+    Document.created_at
+)
+
 @app.get("/")
 async def root():
     return {"message": "Welcome to Personal Knowledge API"}
@@ -41,9 +57,10 @@ async def health_check():
     return {"status": "healthy"}
 
 @app.post("/auth/register", response_model=UserResponse)
-def register(user: UserCreate, db: Session = Depends(get_db)):
+async def register(user: UserCreate, db: AsyncSession = Depends(get_db)):
     # Check if user already exists
-    db_user = db.query(User).filter(User.email == user.email).first()
+    result = await db.execute(select(User.id).where(User.email == user.email))
+    db_user = result.first()
     if db_user:
         raise HTTPException(
             status_code=400,
@@ -51,20 +68,20 @@ def register(user: UserCreate, db: Session = Depends(get_db)):
         )
 
     # Create new user
-    hashed_password = get_password_hash(user.password)
+    hashed_password = await run_in_threadpool(get_password_hash, user.password)
     db_user = User(
         email=user.email,
         hashed_password=hashed_password
     )
     db.add(db_user)
-    db.commit()
-    db.refresh(db_user)
+    await db.commit()
+    await db.refresh(db_user)
 
     return db_user
 
 @app.post("/auth/login", response_model=Token)
-def login(user: UserLogin, db: Session = Depends(get_db)):
-    db_user = authenticate_user(db, user.email, user.password)
+async def login(user: UserLogin, db: AsyncSession = Depends(get_db)):
+    db_user = await authenticate_user(db, user.email, user.password)
     if not db_user:
         raise HTTPException(
             status_code=status.HTTP_401_UNAUTHORIZED,
@@ -75,11 +92,11 @@ def login(user: UserLogin, db: Session = Depends(get_db)):
     # Create access token
     access_token_expires = timedelta(minutes=ACCESS_TOKEN_EXPIRE_MINUTES)
     access_token = create_access_token(
-        data={"sub": db_user.email}, expires_delta=access_token_expires
+        data={"sub": db_user.email, "uid": db_user.id}, expires_delta=access_token_expires
     )
 
     # Create refresh token
-    refresh_token = create_refresh_token(db, db_user.id)
+    refresh_token = await create_refresh_token(db, db_user.id)
 
     return {
         "access_token": access_token,
@@ -88,27 +105,23 @@ def login(user: UserLogin, db: Session = Depends(get_db)):
     }
 
 @app.post("/auth/refresh", response_model=Token)
-def refresh_access_token(token_data: TokenRefresh, db: Session = Depends(get_db)):
-    user = verify_refresh_token(db, token_data.refresh_token)
-    if not user:
+async def refresh_access_token(token_data: TokenRefresh, db: AsyncSession = Depends(get_db)):
+    # Revoke the old refresh token (one-time use) and issue its replacement in one transaction
+    rotated = await rotate_refresh_token(db, token_data.refresh_token)
+    if not rotated:
         raise HTTPException(
             status_code=status.HTTP_401_UNAUTHORIZED,
             detail="Invalid refresh token",
             headers={"WWW-Authenticate": "Bearer"},
         )
-
-    # Revoke old refresh token (security: one-time use)
-    revoke_refresh_token(db, token_data.refresh_token)
+    user_id, email, new_refresh_token = rotated
 
     # Create new access token
     access_token_expires = timedelta(minutes=ACCESS_TOKEN_EXPIRE_MINUTES)
     access_token = create_access_token(
-        data={"sub": user.email}, expires_delta=access_token_expires
+        data={"sub": email, "uid": user_id}, expires_delta=access_token_expires
     )
 
-    # Create new refresh token (token rotation)
-    new_refresh_token = create_refresh_token(db, user.id)
-
     return {
         "access_token": access_token,
         "refresh_token": new_refresh_token,
@@ -116,8 +129,8 @@ def refresh_access_token(token_data: TokenRefresh, db: Session = Depends(get_db)
     }
 
 @app.post("/auth/logout")
-def logout(token_data: TokenRefresh, db: Session = Depends(get_db)):
-    success = revoke_refresh_token(db, token_data.refresh_token)
+async def logout(token_data: TokenRefresh, db: AsyncSession = Depends(get_db)):
+    success = await revoke_refresh_token(db, token_data.refresh_token)
     if not success:
         raise HTTPException(
             status_code=status.HTTP_400_BAD_REQUEST,
@@ -126,30 +139,66 @@ def logout(token_data: TokenRefresh, db: Session = Depends(get_db)):
     return {"message": "Successfully logged out"}
 
 @app.post("/auth/logout-all")
-def logout_all(current_user: User = Depends(get_current_user), db: Session = Depends(get_db)):
-    revoke_all_user_tokens(db, current_user.id)
+async def logout_all(current_user: User = Depends(get_current_user), db: AsyncSession = Depends(get_db)):
+    await revoke_all_user_tokens(db, current_user.id)
     return {"message": "Successfully logged out from all devices"}
 
 @app.get("/auth/me", response_model=UserResponse)
-def read_users_me(current_user: User = Depends(get_current_user)):
+async def read_users_me(current_user: User = Depends(get_current_user)):
     return current_user
 
+async def copy_document_chunks(db: AsyncSession, document_id: int, chunks: List[str]):
+    """Bulk-load chunk rows with COPY inside the session's transaction"""
+    connection = await db.connection()
+    raw_connection = await connection.get_raw_connection()
+    # asyncpg streams the records with binary COPY, no CSV encoding needed
+    await raw_connection.driver_connection.copy_records_to_table(
+        DocumentChunk.__tablename__,
+        records=[(chunk_content, i, document_id) for i, chunk_content in enumerate(chunks)],
+        columns=("content", "chunk_index", "document_id")
+    )
+
+async def save_document_with_chunks(db: AsyncSession, db_document: Document, chunks: List[str]) -> Tuple[int, List[int]]:
+    """Insert a document and its chunks in one transaction
+
+    Returns the document id and the chunk ids in chunk order.
+    """
+    # Flushing returns the new id via INSERT ... RETURNING, no commit/refresh needed
+    db.add(db_document)
+    await db.flush()
+    document_id = db_document.id
+
+    # Stream all chunks into PostgreSQL with a single COPY, committed with the document
+    await copy_document_chunks(db, document_id, chunks)
+    await db.commit()
+
+    # Fetch the generated chunk IDs in a single query, in chunk order
+    result = await db.execute(
+        select(DocumentChunk.id)
+        .where(DocumentChunk.document_id == document_id)
+        .order_by(DocumentChunk.chunk_index)
+    )
+    return document_id, result.scalars().all()
+
 # Document endpoints
 @app.post("/documents/upload", response_model=DocumentResponse)
 async def upload_document(
     file: UploadFile = File(...),
     current_user: User = Depends(get_current_user),
-    db: Session = Depends(get_db)
+    db: AsyncSession = Depends(get_db)
 ):
-    # Read file content
-    content = await file.read()
+    # Reject oversized uploads before reading anything into memory
+    file_size = validate_file_size(file.file)
+
+    # Validate file type from the header only
+    header = await file.read(MIME_SNIFF_SIZE)
+    await file.seek(0)
+    mime_type = validate_file_type(file.filename, header)
 
-    # Validate file
-    mime_type = validate_file_type(file.filename, content)
-    file_size = validate_file_size(content)
+    # Extract text content straight from the spooled upload
+    text_content = await extract_text_from_file(file.file, mime_type, file.filename)
 
-    # Extract text content
-    text_content = await extract_text_from_file(content, mime_type, file.filename)
+    user_id = current_user.id
 
     # Create document record
     db_document = Document(
@@ -159,75 +208,84 @@ async def upload_document(
         content=text_content,
         file_size=file_size,
         mime_type=mime_type,
-        owner_id=current_user.id,
+        owner_id=user_id,
         processed=False
     )
 
-    db.add(db_document)
-    db.commit()
-    db.refresh(db_document)
-
-    # Create text chunks for vector storage
-    chunks = chunk_text(text_content)
-
-    # Create all chunks in database first
-    chunk_objects = []
-    for i, chunk_content in enumerate(chunks):
-        chunk = DocumentChunk(
-            content=chunk_content,
-            chunk_index=i,
-            document_id=db_document.id
-        )
-        chunk_objects.append(chunk)
-        db.add(chunk)
-
-    db.commit()  # Commit all chunks at once
+    # Create text chunks for vector storage; splitting megabytes of text would stall the event loop
+    chunks = await run_in_threadpool(chunk_text, text_content)
 
-    # Refresh all chunks to get their IDs
-    for chunk in chunk_objects:
-        db.refresh(chunk)
+    # Start embedding right away so the OpenAI round-trips overlap the database writes
+    embedding_task = asyncio.create_task(vector_store.get_embeddings_batch(chunks))
+    try:
+        document_id, chunk_ids = await save_document_with_chunks(db, db_document, chunks)
+    except Exception:
+        embedding_task.cancel()
+        raise
+    embeddings = await embedding_task
 
     # Prepare data for batch embedding processing
     chunk_data = []
-    for chunk in chunk_objects:
+    for chunk_id, chunk_content in zip(chunk_ids, chunks):
         chunk_data.append({
-            "chunk_id": chunk.id,
-            "text": chunk.content,
-            "document_id": db_document.id,
-            "user_id": current_user.id
+            "chunk_id": chunk_id,
+            "text": chunk_content,
+            "document_id": document_id,
+            "user_id": user_id
         })
 
-    # Create vector embeddings in batch
-    await vector_store.store_chunk_embeddings_batch(chunk_data)
+    # Store the vector embeddings in batch
+    await vector_store.store_chunk_embeddings_batch(chunk_data, embeddings)
 
-    # Mark document as processed
-    db_document.processed = True
-    db.commit()
-    db.refresh(db_document)
+    # Mark document as processed without loading the expired row first
+    await db.execute(
+        update(Document).where(Document.id == document_id).values(processed=True)
+        .execution_options(synchronize_session=False)
+    )
+    await db.commit()
+
+    # Reload only what the response needs, not the full text content
+    await db.refresh(db_document, attribute_names=[column.key for column in DOCUMENT_SUMMARY_COLUMNS])
 
     return db_document
 
 @app.get("/documents", response_model=DocumentListResponse)
-def list_documents(
+async def list_documents(
+    skip: int = Query(0, ge=0),
+    limit: int = Query(50, ge=1, le=100),
     current_user: User = Depends(get_current_user),
-    db: Session = Depends(get_db)
+    db: AsyncSession = Depends(get_db)
 ):
-    documents = db.query(Document).filter(Document.owner_id == current_user.id).all()
-    return {
+    owned = Document.owner_id == current_user.id
+
+    # Count in the database instead of materializing every row
+    total = (await db.execute(select(func.count(Document.id)).where(owned))).scalar()
+    # Plain rows of just the summary columns, no ORM objects to build
+    result = await db.execute(
+        select(*DOCUMENT_SUMMARY_COLUMNS).where(owned)
+        .order_by(Document.id).offset(skip).limit(limit)
+    )
+    documents = [row._asdict() for row in result]
+
+    # Server-built payload already matches DocumentListResponse; skip re-validating every row
+    return ORJSONResponse({
         "documents": documents,
-        "total": len(documents)
-    }
+        "total": total
+    })
 
 @app.get("/documents/{document_id}", response_model=DocumentResponse)
-def get_document(
+async def get_document(
     document_id: int,
     current_user: User = Depends(get_current_user),
-    db: Session = Depends(get_db)
+    db: AsyncSession = Depends(get_db)
 ):
-    document = db.query(Document).filter(
-        Document.id == document_id,
-        Document.owner_id == current_user.id
-    ).first()
+    result = await db.execute(
+        select(Document).options(load_only(*DOCUMENT_SUMMARY_COLUMNS)).where(
+            Document.id == document_id,
+            Document.owner_id == current_user.id
+        )
+    )
+    document = result.scalars().first()
 
     if not document:
         raise HTTPException(status_code=404, detail="Document not found")
@@ -238,12 +296,15 @@ def get_document(
 async def delete_document(
     document_id: int,
     current_user: User = Depends(get_current_user),
-    db: Session = Depends(get_db)
+    db: AsyncSession = Depends(get_db)
 ):
-    document = db.query(Document).filter(
-        Document.id == document_id,
-        Document.owner_id == current_user.id
-    ).first()
+    result = await db.execute(
+        select(Document).options(load_only(Document.id)).where(
+            Document.id == document_id,
+            Document.owner_id == current_user.id
+        )
+    )
+    document = result.scalars().first()
 
     if not document:
         raise HTTPException(status_code=404, detail="Document not found")
@@ -251,12 +312,10 @@ async def delete_document(
     # Delete vector embeddings
     await vector_store.delete_document_embeddings(document_id, current_user.id)
 
-    # Delete associated chunks
-    db.query(DocumentChunk).filter(DocumentChunk.document_id == document_id).delete()
-
-    # Delete document
-    db.delete(document)
-    db.commit()
+    # Delete document; its chunks are removed by the ON DELETE CASCADE foreign key
+    await db.delete(document)
+    await db.commit()
+    rag_service.forget_document(document_id)
 
     return {"message": "Document deleted successfully"}
 
@@ -283,8 +342,20 @@ async def search_documents(
 async def ask_question(
     question_request: QuestionRequest,
     current_user: User = Depends(get_current_user),
-    db: Session = Depends(get_db)
+    db: AsyncSession = Depends(get_db)
 ):
+    # Stream the answer as server-sent events so the first tokens arrive right away
+    if question_request.stream:
+        return StreamingResponse(
+            rag_service.stream_answer(
+                question=question_request.question,
+                user_id=current_user.id,
+                db=db,
+                document_ids=question_request.document_ids
+            ),
+            media_type="text/event-stream"
+        )
+
     # Generate answer using RAG
     result = await rag_service.generate_answer(
         question=question_request.question,
@@ -1,4 +1,4 @@
-from sqlalchemy import Column, Integer, String, DateTime, Text, ForeignKey, Boolean
+from sqlalchemy import Column, Integer, String, DateTime, Text, ForeignKey, Boolean, Index, LargeBinary, text
 from sqlalchemy.orm import relationship
 from sqlalchemy.sql import func
 from database import Base
@@ -19,7 +19,7 @@ class RefreshToken(Base):
     __tablename__ = "refresh_tokens"
 
     id = Column(Integer, primary_key=True, index=True)
-    token = Column(String, unique=True, index=True, nullable=False)
+    token_hash = Column(LargeBinary(32), unique=True, index=True, nullable=False)  # SHA-256 of the issued token
     user_id = Column(Integer, ForeignKey("users.id"), nullable=False)
     expires_at = Column(DateTime(timezone=True), nullable=False)
     is_active = Column(Boolean, default=True)
@@ -27,6 +27,11 @@ class RefreshToken(Base):
 
     user = relationship("User", back_populates="refresh_tokens")
 
+    __table_args__ = (
+        # Revoked tokens accumulate, so only index the live ones per user
+        Index("ix_refresh_tokens_user_id_active", "user_id", postgresql_where=text("is_active")),
+    )
+
 class Document(Base):
     __tablename__ = "documents"
 
@@ -40,9 +45,9 @@ class Document(Base):
     processed = Column(Boolean, default=False)
     created_at = Column(DateTime(timezone=True), server_default=func.now())
 
-    owner_id = Column(Integer, ForeignKey("users.id"))
+    owner_id = Column(Integer, ForeignKey("users.id"), index=True)
     owner = relationship("User", back_populates="documents")
-    chunks = relationship("DocumentChunk", back_populates="document")
+    chunks = relationship("DocumentChunk", back_populates="document", cascade="all, delete-orphan", passive_deletes=True)
 
 class DocumentChunk(Base):
     __tablename__ = "document_chunks"
@@ -53,5 +58,5 @@ class DocumentChunk(Base):
     vector_id = Column(String)  # Reference to vector in Pinecone
     created_at = Column(DateTime(timezone=True), server_default=func.now())
 
-    document_id = Column(Integer, ForeignKey("documents.id"))
+    document_id = Column(Integer, ForeignKey("documents.id", ondelete="CASCADE"), index=True)
     document = relationship("Document", back_populates="chunks")
\ No newline at end of file
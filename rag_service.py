@@ -1,9 +1,12 @@
 import os
 import openai
-from typing import List, Dict, Optional
+import orjson
+from cachetools import TTLCache
+from typing import AsyncIterator, List, Dict, Optional, Tuple
 from dotenv import load_dotenv
 import logging
-from sqlalchemy.orm import Session
+from sqlalchemy import select
+from sqlalchemy.ext.asyncio import AsyncSession
 from models import Document
 from vector_store import vector_store
 
@@ -11,6 +14,18 @@ load_dotenv()
 
 logger = logging.getLogger(__name__)
 
+CHAT_MODEL = "gpt-3.5-turbo"
+SERVICE_UNAVAILABLE_ANSWER = "RAG service is not available. Please check OpenAI API configuration."
+NO_CONTEXT_ANSWER = "I couldn't find any relevant information in your documents to answer this question."
+
+# Titles of documents cited as sources: document_id -> title. Titles never change after
+# upload and every chunk returned by the vector search is already scoped to its owner.
+_title_cache = TTLCache(maxsize=10_000, ttl=600)
+
+def _sse(event: str, data) -> bytes:
+    """Encode one server-sent event with a JSON payload"""
+    return b"event: " + event.encode() + b"\ndata: " + orjson.dumps(data) + b"\n\n"
+
 class RAGService:
     def __init__(self):
         self.openai_api_key = os.getenv("OPENAI_API_KEY")
@@ -26,22 +41,19 @@ class RAGService:
     def is_available(self) -> bool:
         return hasattr(self, 'available') and self.available
 
-    async def generate_answer(
+    def forget_document(self, document_id: int):
+        """Drop a deleted document's cached title"""
+        _title_cache.pop(document_id, None)
+
+    async def _retrieve_context(
         self,
         question: str,
         user_id: int,
-        db: Session,
-        document_ids: Optional[List[int]] = None,
-        max_chunks: int = 5
-    ) -> Dict:
-        """Generate an answer using RAG approach"""
-        if not self.is_available():
-            return {
-                "answer": "RAG service is not available. Please check OpenAI API configuration.",
-                "sources": [],
-                "question": question
-            }
-
+        db: AsyncSession,
+        document_ids: Optional[List[int]],
+        max_chunks: int
+    ) -> Tuple[List[Dict], List[Dict]]:
+        """Return the chat messages and sources for a question (no messages if nothing matched)"""
         # Step 1: Get relevant chunks using vector search
         chunks = await vector_store.search_similar_chunks(
             query=question,
@@ -51,18 +63,24 @@ class RAGService:
         )
 
         if not chunks:
-            return {
-                "answer": "I couldn't find any relevant information in your documents to answer this question.",
-                "sources": [],
-                "question": question
-            }
+            return [], []
 
         # Step 2: Get document titles for sources
         document_map = {}
-        if chunks:
-            doc_ids = list(set(chunk["document_id"] for chunk in chunks))
-            documents = db.query(Document).filter(Document.id.in_(doc_ids)).all()
-            document_map = {doc.id: doc.title for doc in documents}
+        missing_ids = []
+        for doc_id in set(chunk["document_id"] for chunk in chunks):
+            title = _title_cache.get(doc_id)
+            if title is None:
+                missing_ids.append(doc_id)
+            else:
+                document_map[doc_id] = title
+
+        # Only hit the database for titles not seen recently
+        if missing_ids:
+            result = await db.execute(select(Document.id, Document.title).where(Document.id.in_(missing_ids)))
+            for doc_id, title in result:
+                document_map[doc_id] = title
+                _title_cache[doc_id] = title
 
         # Step 3: Prepare context for LLM
         context_text = "\n\n".join([
@@ -72,30 +90,57 @@ class RAGService:
 
         # Step 4: Create prompt for answer generation
         prompt = self._create_rag_prompt(question, context_text)
+        messages = [
+            {"role": "system", "content": "You are a helpful assistant that answers questions based on provided context from documents. Always base your answers on the given context and be concise but comprehensive."},
+            {"role": "user", "content": prompt}
+        ]
+
+        # Step 5: Prepare sources
+        sources = []
+        for chunk in chunks:
+            sources.append({
+                "document_id": chunk["document_id"],
+                "title": document_map.get(chunk["document_id"], "Unknown"),
+                "chunk_id": chunk["chunk_id"]
+            })
+
+        return messages, sources
+
+    async def generate_answer(
+        self,
+        question: str,
+        user_id: int,
+        db: AsyncSession,
+        document_ids: Optional[List[int]] = None,
+        max_chunks: int = 5
+    ) -> Dict:
+        """Generate an answer using RAG approach"""
+        if not self.is_available():
+            return {
+                "answer": SERVICE_UNAVAILABLE_ANSWER,
+                "sources": [],
+                "question": question
+            }
+
+        messages, sources = await self._retrieve_context(question, user_id, db, document_ids, max_chunks)
+        if not messages:
+            return {
+                "answer": NO_CONTEXT_ANSWER,
+                "sources": [],
+                "question": question
+            }
 
         try:
-            # Step 5: Generate answer using OpenAI
-            response = openai.ChatCompletion.create(
-                model="gpt-3.5-turbo",
-                messages=[
-                    {"role": "system", "content": "You are a helpful assistant that answers questions based on provided context from documents. Always base your answers on the given context and be concise but comprehensive."},
-                    {"role": "user", "content": prompt}
-                ],
+            # Generate answer using OpenAI without blocking the event loop
+            response = await openai.ChatCompletion.acreate(
+                model=CHAT_MODEL,
+                messages=messages,
                 max_tokens=500,
                 temperature=0.3
             )
 
             answer = response.choices[0].message.content.strip()
 
-            # Step 6: Prepare sources
-            sources = []
-            for chunk in chunks:
-                sources.append({
-                    "document_id": chunk["document_id"],
-                    "title": document_map.get(chunk["document_id"], "Unknown"),
-                    "chunk_id": chunk["chunk_id"]
-                })
-
             return {
                 "answer": answer,
                 "sources": sources,
@@ -110,6 +155,51 @@ class RAGService:
                 "question": question
             }
 
+    async def stream_answer(
+        self,
+        question: str,
+        user_id: int,
+        db: AsyncSession,
+        document_ids: Optional[List[int]] = None,
+        max_chunks: int = 5
+    ) -> AsyncIterator[bytes]:
+        """Generate an answer as server-sent events
+
+        Emits a `sources` event first, then a `token` event per completion
+        delta and finally `done`; failures are reported as an `error` event.
+        """
+        if not self.is_available():
+            yield _sse("sources", [])
+            yield _sse("token", SERVICE_UNAVAILABLE_ANSWER)
+            yield _sse("done", None)
+            return
+
+        messages, sources = await self._retrieve_context(question, user_id, db, document_ids, max_chunks)
+        yield _sse("sources", sources)
+        if not messages:
+            yield _sse("token", NO_CONTEXT_ANSWER)
+            yield _sse("done", None)
+            return
+
+        try:
+            response = await openai.ChatCompletion.acreate(
+                model=CHAT_MODEL,
+                messages=messages,
+                max_tokens=500,
+                temperature=0.3,
+                stream=True
+            )
+            async for chunk in response:
+                content = chunk["choices"][0]["delta"].get("content")
+                if content:
+                    yield _sse("token", content)
+        except Exception as e:
+            logger.error(f"Error streaming answer: {e}")
+            yield _sse("error", f"I encountered an error while generating the answer: {str(e)}")
+            return
+
+        yield _sse("done", None)
+
     def _create_rag_prompt(self, question: str, context: str) -> str:
         """Create a prompt for RAG answer generation"""
         return f"""Based on the following context from the user's documents, please answer the question. If the context doesn't contain enough information to fully answer the question, say so and provide what information is available.
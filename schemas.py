@@ -29,6 +29,7 @@ class TokenRefresh(BaseModel):
 
 class TokenData(BaseModel):
     email: Optional[str] = None
+    user_id: Optional[int] = None
 
 class DocumentResponse(BaseModel):
     id: int
@@ -66,6 +67,7 @@ class QuestionRequest(BaseModel):
     question: str
     document_ids: Optional[List[int]] = None
     include_sources: bool = True
+    stream: bool = False
 
 class SourceInfo(BaseModel):
     document_id: int
@@ -1,5 +1,10 @@
+import asyncio
+import hashlib
 import os
+import numpy as np
 import openai
+from cachetools import TTLCache
+from fastapi.concurrency import run_in_threadpool
 from pinecone import Pinecone
 from typing import List, Dict, Optional
 from dotenv import load_dotenv
@@ -9,6 +14,26 @@ load_dotenv()
 
 logger = logging.getLogger(__name__)
 
+EMBEDDING_MODEL = "text-embedding-3-small"
+
+# OpenAI allows up to 2048 inputs and 300k tokens per request
+EMBEDDING_BATCH_SIZE = 100  # Conservative batch size for stability
+EMBEDDING_BATCH_TOKEN_BUDGET = 250_000
+APPROX_CHARS_PER_TOKEN = 4
+MAX_CONCURRENT_EMBEDDING_REQUESTS = 8  # Stay well inside OpenAI rate limits
+
+# Pinecone recommends upserts of ~100 vectors per request
+UPSERT_BATCH_SIZE = 100
+MAX_CONCURRENT_UPSERT_REQUESTS = 10
+
+# Query embeddings for repeated searches/questions: (model, text) -> float16 bytes,
+# half the footprint of float32 for a negligible recall cost
+_query_embedding_cache = TTLCache(maxsize=5000, ttl=3600)
+
+# Retrieved chunks, so an /ask right after a /search for the same text reuses the
+# same retrieval: (user_id, query digest, top_k, document_ids) -> chunks
+_search_cache = TTLCache(maxsize=2000, ttl=10)
+
 class VectorStore:
     def __init__(self):
         self.openai_api_key = os.getenv("OPENAI_API_KEY")
@@ -50,49 +75,77 @@ class VectorStore:
         if not self.is_available():
             return None
 
+        cleaned_text = text.replace("\n", " ")
+        cache_key = (EMBEDDING_MODEL, cleaned_text)
+        cached = _query_embedding_cache.get(cache_key)
+        if cached is not None:
+            # Pinecone only accepts float32 vectors
+            return np.frombuffer(cached, dtype=np.float16).astype(np.float32).tolist()
+
         try:
-            response = openai.Embedding.create(
-                model="text-embedding-3-small",
-                input=text.replace("\n", " ")
+            response = await openai.Embedding.acreate(
+                model=EMBEDDING_MODEL,
+                input=cleaned_text
             )
-            return response['data'][0]['embedding']
+            embedding = response['data'][0]['embedding']
+            _query_embedding_cache[cache_key] = np.asarray(embedding, dtype=np.float16).tobytes()
+            return embedding
         except Exception as e:
             logger.error(f"Error generating embedding: {e}")
             return None
 
     async def get_embeddings_batch(self, texts: List[str]) -> List[Optional[List[float]]]:
-        """Get embeddings for multiple texts in a single API call"""
+        """Get embeddings for multiple texts, sending the API batches concurrently"""
         if not self.is_available():
             return [None] * len(texts)
 
         if not texts:
             return []
 
-        try:
-            # Clean texts and prepare for batch processing
-            cleaned_texts = [text.replace("\n", " ") for text in texts]
-
-            # OpenAI allows up to 2048 inputs per request
-            batch_size = 100  # Conservative batch size for stability
-            all_embeddings = []
-
-            for i in range(0, len(cleaned_texts), batch_size):
-                batch = cleaned_texts[i:i + batch_size]
-
-                response = openai.Embedding.create(
-                    model="text-embedding-3-small",
-                    input=batch
+        # Clean texts and prepare for batch processing
+        cleaned_texts = [text.replace("\n", " ") for text in texts]
+
+        # Pack texts shortest-first into batches bounded by both input count and
+        # estimated tokens, so one long chunk doesn't bloat an otherwise small batch
+        batches = []
+        batch, batch_tokens = [], 0
+        for i in sorted(range(len(cleaned_texts)), key=lambda i: len(cleaned_texts[i])):
+            tokens = len(cleaned_texts[i]) // APPROX_CHARS_PER_TOKEN + 1
+            if batch and (len(batch) == EMBEDDING_BATCH_SIZE or batch_tokens + tokens > EMBEDDING_BATCH_TOKEN_BUDGET):
+                batches.append(batch)
+                batch, batch_tokens = [], 0
+            batch.append(i)
+            batch_tokens += tokens
+        if batch:
+            batches.append(batch)
+
+        semaphore = asyncio.Semaphore(MAX_CONCURRENT_EMBEDDING_REQUESTS)
+
+        async def embed_batch(indices: List[int]) -> List[List[float]]:
+            async with semaphore:
+                response = await openai.Embedding.acreate(
+                    model=EMBEDDING_MODEL,
+                    input=[cleaned_texts[i] for i in indices]
                 )
-
-                # Extract embeddings in the correct order
-                batch_embeddings = [item['embedding'] for item in response['data']]
-                all_embeddings.extend(batch_embeddings)
-
-            return all_embeddings
-
-        except Exception as e:
-            logger.error(f"Error generating batch embeddings: {e}")
-            return [None] * len(texts)
+            # Extract embeddings in the correct order
+            return [item['embedding'] for item in response['data']]
+
+        # Send all batches concurrently instead of one round-trip after another
+        responses = await asyncio.gather(
+            *(embed_batch(indices) for indices in batches),
+            return_exceptions=True
+        )
+
+        # Put embeddings back in the caller's order
+        all_embeddings = [None] * len(texts)
+        for indices, result in zip(batches, responses):
+            if isinstance(result, Exception):
+                logger.error(f"Error generating batch embeddings: {result}")
+                continue
+            for i, embedding in zip(indices, result):
+                all_embeddings[i] = embedding
+
+        return all_embeddings
 
     async def store_chunk_embedding(self, chunk_id: int, text: str, document_id: int, user_id: int) -> bool:
         if not self.is_available():
@@ -113,13 +166,22 @@ class VectorStore:
                     "text": text[:1000]  # Store truncated text for preview
                 }
             }])
+            self._forget_user_searches(user_id)
             return True
         except Exception as e:
             logger.error(f"Error storing embedding for chunk {chunk_id}: {e}")
             return False
 
-    async def store_chunk_embeddings_batch(self, chunk_data: List[Dict]) -> List[bool]:
-        """Store multiple chunk embeddings in batches"""
+    async def store_chunk_embeddings_batch(
+        self,
+        chunk_data: List[Dict],
+        embeddings: Optional[List[Optional[List[float]]]] = None
+    ) -> List[bool]:
+        """Store multiple chunk embeddings in batches
+
+        Pass `embeddings` (aligned with `chunk_data`) when they were generated
+        ahead of time; otherwise they are generated here.
+        """
         if not self.is_available():
             return [False] * len(chunk_data)
 
@@ -127,17 +189,18 @@ class VectorStore:
             return []
 
         try:
-            # Extract texts for batch embedding generation
-            texts = [item["text"] for item in chunk_data]
-            embeddings = await self.get_embeddings_batch(texts)
+            if embeddings is None:
+                # Extract texts for batch embedding generation
+                texts = [item["text"] for item in chunk_data]
+                embeddings = await self.get_embeddings_batch(texts)
 
-            # Prepare vectors for Pinecone upsert
+            # Prepare vectors for Pinecone upsert, remembering which chunk each came from
             vectors = []
-            results = []
+            vector_positions = []
+            results = [False] * len(chunk_data)
 
             for i, (chunk_info, embedding) in enumerate(zip(chunk_data, embeddings)):
                 if embedding is None:
-                    results.append(False)
                     continue
 
                 vectors.append({
@@ -150,11 +213,32 @@ class VectorStore:
                         "text": chunk_info["text"][:1000]  # Store truncated text for preview
                     }
                 })
-                results.append(True)
+                vector_positions.append(i)
+
+            semaphore = asyncio.Semaphore(MAX_CONCURRENT_UPSERT_REQUESTS)
+
+            async def upsert_batch(batch: List[Dict]):
+                async with semaphore:
+                    # The SDK call blocks on HTTP, so run each batch in its own thread
+                    await run_in_threadpool(self.index.upsert, vectors=batch)
+
+            # Upsert the batches concurrently instead of one large serial request
+            starts = range(0, len(vectors), UPSERT_BATCH_SIZE)
+            responses = await asyncio.gather(
+                *(upsert_batch(vectors[start:start + UPSERT_BATCH_SIZE]) for start in starts),
+                return_exceptions=True
+            )
+
+            # New vectors should show up in the next search, not after the cache expires
+            for user_id in {chunk_info["user_id"] for chunk_info in chunk_data}:
+                self._forget_user_searches(user_id)
 
-            # Batch upsert to Pinecone
-            if vectors:
-                self.index.upsert(vectors)
+            for start, result in zip(starts, responses):
+                if isinstance(result, Exception):
+                    logger.error(f"Error upserting batch embeddings: {result}")
+                    continue
+                for i in vector_positions[start:start + UPSERT_BATCH_SIZE]:
+                    results[i] = True
 
             return results
 
@@ -172,6 +256,16 @@ class VectorStore:
         if not self.is_available():
             return []
 
+        cache_key = (
+            user_id,
+            hashlib.blake2b(query.encode(), digest_size=16).digest(),
+            top_k,
+            tuple(sorted(document_ids)) if document_ids else None
+        )
+        cached = _search_cache.get(cache_key)
+        if cached is not None:
+            return cached
+
         query_embedding = await self.get_embedding(query)
         if not query_embedding:
             return []
@@ -197,30 +291,26 @@ class VectorStore:
                     "score": match.score
                 })
 
+            _search_cache[cache_key] = chunks
             return chunks
         except Exception as e:
             logger.error(f"Error searching similar chunks: {e}")
             return []
 
+    def _forget_user_searches(self, user_id: int):
+        """Drop cached search results once a user's vectors change"""
+        for key in list(_search_cache.keys()):
+            if key[0] == user_id:
+                _search_cache.pop(key, None)
+
     async def delete_document_embeddings(self, document_id: int, user_id: int) -> bool:
         if not self.is_available():
             return True  # Consider it successful if vector store is not available
 
         try:
-            # Query all chunks for the document
-            filter_dict = {"document_id": document_id, "user_id": user_id}
-            results = self.index.query(
-                vector=[0] * 1536,  # Dummy vector for filtering
-                top_k=10000,  # Large number to get all chunks
-                include_metadata=True,
-                filter=filter_dict
-            )
-
-            # Delete all found embeddings
-            if results.matches:
-                chunk_ids = [f"chunk_{match.metadata['chunk_id']}" for match in results.matches]
-                self.index.delete(ids=chunk_ids)
-
+            # Delete by metadata directly; no similarity query, no 10000-match cap
+            self.index.delete(filter={"document_id": document_id, "user_id": user_id})
+            self._forget_user_searches(user_id)
             return True
         except Exception as e:
             logger.error(f"Error deleting embeddings for document {document_id}: {e}")